@@ -32,6 +32,8 @@ Options:
   enc          フォーマットとデータの<file>ファイル(json形式)から赤外線コードを生成して<code_name>という名前で保存. 
   <code_name>  赤外線コードの名前. rec, send, delでは複数指定可能. 
   -c <path>    登録済み赤外線コードを保存, 読み出すファイル名かパス. デフォルトはcodes.json
+               既存のファイルは読み出した時と同じ形式で保存. 新しく作る場合は
+               拡張子が.cgirならバイナリ形式, それ以外はjson形式で保存. 
   -g <gpio>    送受信に使うGPIO番号. デフォルトは送信13, 受信4. 
   -w <wait>    複数のコードを送信する場合の間隔を秒数で指定. デフォルトは1. 
   -f <file>    ファイル名. 
@@ -41,6 +43,7 @@ Options:
 from docopt import docopt
 import time
 import json
+import pigpio
 from .infrared import *
 
 
@@ -50,7 +53,20 @@ def cli():
   """
   args = docopt(__doc__)
   ir = Infrared()
+  try:
+    _run(args, ir)
+  finally:
+    ir.close()  # pigpioとの接続を終了
 
+
+def _run(args, ir):
+  """
+  コマンドラインの引数に従って処理を実行
+
+  Args:
+    args: docoptで解析した引数
+    ir: Infraredのインスタンス
+  """
   # 登録済み赤外線コードを読み出す
   if args['-c'] != None:
     ir.codes_path = args['-c']
@@ -121,8 +137,12 @@ def cli():
         time.sleep(wait)
       if cname in ir.codes:
         print('赤外線コード "{}" を送信中...'.format(cname))
-        if not ir.send(ir.codes[cname]):
-          print('送信失敗. pigpioに接続できません.\n')
+        try:
+          if not ir.send(ir.codes[cname]):
+            print('送信失敗. pigpioに接続できません.\n')
+            return
+        except pigpio.error:
+          print('送信失敗. pigpioの波形数の上限に達しています. 波形を使う他のプログラムを終了してください.\n')
           return
       else:
         print('赤外線コード "{}" が見つかりません.'.format(cname))
@@ -176,7 +196,7 @@ def cli():
       with open(args['-f'], 'w') as f:
         f.write(json.dumps(obj, indent=2, ensure_ascii=False))
         print('\nファイル "{}" へ保存しました.'.format(args['-f']))
-    except:
+    except OSError:
       print('\nファイルへ保存に失敗しました.')
 
   # エンコード
@@ -184,7 +204,7 @@ def cli():
     try:
       with open(args['-f'], 'r') as f:
         obj = json.load(f)
-    except:
+    except (OSError, ValueError):
       print('\nファイル "{}" の読み出しに失敗しました.'.format(args['-f']))
       return
 
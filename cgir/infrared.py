@@ -6,7 +6,19 @@ GitHub: https://github.com/IndoorCorgi/cgir
 
 import pigpio
 import time
+import threading
+import atexit
 import json
+import struct
+from array import array
+from functools import lru_cache
+
+# orjsonがインストールされていればcodesファイルの読み出しに使う
+try:
+  import orjson
+  _json_loads = orjson.loads
+except ImportError:
+  _json_loads = json.loads
 
 # 定数
 FORMAT_UNKNOWN = "Unknown"  # フォーマット不明
@@ -24,6 +36,461 @@ _T_AEHA = 425  # AEHAフォーマットの基準周期[us]
 _T_NEC = 560  # NECフォーマットの基準周期[us]
 _T_SONY = 600  # SONYフォーマットの基準周期[us]
 _T_WAIT = 10000  # encode, decodeで使用するフレーム間の時間[us]
+_T_WAIT_MIN = _T_WAIT // 2  # decodeでこれより長いSpaceはフレーム間と判定する[us]
+_BIN_MAGIC = b'CGIR\x01'  # バイナリ形式のcodesファイルの先頭に付ける識別子
+_BIN_EXT = '.cgir'  # 新しく作るcodesファイルをバイナリ形式にする拡張子
+
+# このプロセスのsendで生成した波形. key:(GPIO, Mark長さ, Space長さ), value:ID
+# pigpioの波形はデーモン内に保存され全ての接続から共有されるので, プロセス内の全ての
+# Infraredで共有し, close()とプロセス終了時に_delete_wavesでまとめて削除する
+_waves = {}
+_waves_lock = threading.Lock()  # _wavesと波形の生成, 送信, 削除をスレッド間で排他する
+
+
+def _delete_waves(pi):
+  """
+  送信が終わるのを待ってこのプロセスで生成した波形を削除し, _wavesを空にする
+
+  Args:
+    pi: pigpioへの接続
+  """
+  while pi.wave_tx_busy():
+    time.sleep(0.01)
+  for wid in _waves.values():
+    pi.wave_delete(wid)
+  _waves.clear()
+
+
+@atexit.register
+def _delete_waves_at_exit():
+  """
+  プロセス終了時に, close()されずに残っている波形をpigpioから削除する
+  """
+  with _waves_lock:
+    if not _waves:
+      return
+    pi = pigpio.pi()
+    if pi.connected:
+      _delete_waves(pi)
+      pi.stop()
+
+
+def _cl_bounds(target):
+  """
+  赤外線のMark, Spaceの長さが目標値+/-35%と一致するかを判定するための整数の範囲を返す
+  lo <= length <= hi なら一致. 
+
+  Args:
+    target: フォーマットなどで決まっている目標値
+  
+  Returns:
+    int: 許容範囲の下限
+    int: 許容範囲の上限
+  """
+  return target * 65 // 100 + 1, (target * 135 - 1) // 100
+
+
+# Mark, Spaceの長さの判定範囲. key:(基準周期t, tの倍数), value:(下限, 上限)
+_CL_BOUNDS = {
+    (t, mult): _cl_bounds(t * mult) for t in (_T_AEHA, _T_NEC, _T_SONY) for mult in (1, 2, 3, 4, 8, 16)
+}
+
+# decodeで使用するフォーマットごとの判定範囲. key:名前, value:(下限, 上限)
+_BOUNDS_AEHA = {
+    'leader_mark': _CL_BOUNDS[(_T_AEHA, 8)],
+    'leader_space': _CL_BOUNDS[(_T_AEHA, 4)],
+    'repeat_space': _CL_BOUNDS[(_T_AEHA, 8)],
+    'bit_t': _CL_BOUNDS[(_T_AEHA, 1)],
+    'bit_3t': _CL_BOUNDS[(_T_AEHA, 3)],
+}
+_BOUNDS_NEC = {
+    'leader_mark': _CL_BOUNDS[(_T_NEC, 16)],
+    'leader_space': _CL_BOUNDS[(_T_NEC, 8)],
+    'repeat_space': _CL_BOUNDS[(_T_NEC, 4)],
+    'bit_t': _CL_BOUNDS[(_T_NEC, 1)],
+    'bit_3t': _CL_BOUNDS[(_T_NEC, 3)],
+}
+_BOUNDS_SONY = {
+    'leader_mark': _CL_BOUNDS[(_T_SONY, 4)],
+    'leader_space': _CL_BOUNDS[(_T_SONY, 1)],
+    'bit_t': _CL_BOUNDS[(_T_SONY, 1)],
+    'bit_2t': _CL_BOUNDS[(_T_SONY, 2)],
+}
+
+# フォーマットごとのパラメータ. decodeではこの順にLeaderを判定する
+# key:フォーマット, value:(基準周期t, LeaderのMarkのtの数, LeaderのSpaceのtの数, 判定範囲)
+_FMT_PARAMS = {
+    FORMAT_AEHA: (_T_AEHA, 8, 4, _BOUNDS_AEHA),
+    FORMAT_NEC: (_T_NEC, 16, 8, _BOUNDS_NEC),
+    FORMAT_SONY: (_T_SONY, 4, 1, _BOUNDS_SONY),
+}
+
+
+def _cl(length, bounds):
+  """
+  赤外線のMark, Spaceの長さが判定範囲内か確認する
+
+  Args:
+    length: 実測長さ
+    bounds: _cl_boundsで求めた(下限, 上限)
+  
+  Returns:
+    bool: 範囲内に一致したらTrue. それ以外はFalse
+  """
+  return bounds[0] <= length <= bounds[1]
+
+
+def _decode_aeha_nec(code, bounds):
+  """
+  AEHA, NECフォーマットの赤外線データ(code)のLeader以降を解析してバイト列(frames)を返す
+
+  Args:
+    code: 赤外線データ
+    bounds: フォーマットごとの判定範囲. _BOUNDS_AEHA / _BOUNDS_NEC
+  
+  Returns:
+    list: バイト列データ(frames). 解析に失敗したらNone
+  """
+  lo_t, hi_t = bounds['bit_t']
+  lo_3t, hi_3t = bounds['bit_3t']
+  lo_lm, hi_lm = bounds['leader_mark']
+  lo_ls, hi_ls = bounds['leader_space']
+  lo_rs, hi_rs = bounds['repeat_space']
+
+  frames = []
+  byte_list = []
+  byte = 0
+  bit_counter = 0
+  end_of_frame = False
+
+  # Leader以降を(Mark, Space)の組ごとに処理する. 最後のStopは含まない
+  for mark, space in zip(code[2::2], code[3::2]):
+    # 新しいフレームの開始. フォーマットに合ったLeaderかRepeatか確認
+    if end_of_frame:
+      if lo_lm <= mark <= hi_lm and (lo_ls <= space <= hi_ls or lo_rs <= space <= hi_rs):
+        end_of_frame = False
+        continue
+      else:
+        return None
+
+    # フレームの途中のMarkは全てt
+    if not lo_t <= mark <= hi_t:
+      return None
+
+    # Spaceの長さで分類する
+    # Data 0
+    if lo_t <= space <= hi_t:
+      bit_counter += 1
+    # Data 1
+    elif lo_3t <= space <= hi_3t:
+      byte |= 1 << bit_counter
+      bit_counter += 1
+
+    # Stopの後に長いSpaceがある場合は次のフレームがあると解釈
+    elif space > _T_WAIT_MIN:
+      frames.append(byte_list)
+      byte_list = []
+      byte = 0
+      end_of_frame = True
+      continue
+
+    # 不明なbit
+    else:
+      return None
+
+    # 8bit揃ったらバイト列に追加
+    if bit_counter == 8:
+      byte_list.append(byte)
+      byte = 0
+      bit_counter = 0
+
+  # 最後はフレームの途中のStopで終わる必要がある
+  if len(code) % 2 == 0 or end_of_frame:
+    return None
+
+  # Stopの長さとデータのbit数がByte単位か確認
+  if lo_t <= code[-1] <= hi_t and bit_counter == 0:
+    frames.append(byte_list)
+    return frames
+  else:
+    return None
+
+
+def _decode_sony(code, bounds):
+  """
+  SONYフォーマットの赤外線データ(code)のLeader以降を解析してバイト列(frames)を返す
+
+  Args:
+    code: 赤外線データ
+    bounds: フォーマットの判定範囲. _BOUNDS_SONY
+  
+  Returns:
+    list: バイト列データ(frames). 解析に失敗したらNone
+  """
+  lo_t, hi_t = bounds['bit_t']
+  lo_2t, hi_2t = bounds['bit_2t']
+  lo_4t, hi_4t = bounds['leader_mark']
+
+  frames = []
+  byte_list = []
+  byte = 0
+  bit_counter = 0
+  last = len(code) - 1  # 最後のindex
+
+  for i in range(1, len(code), 2):
+    # 長いSpaceの後にLeaderがある場合は次のフレームと解釈
+    if code[i] > _T_WAIT_MIN and lo_4t <= code[i + 1] <= hi_4t and i <= last - 2:
+      byte_list.append(byte & 0x7F)
+      byte_list.append(byte >> 7)
+      frames.append(byte_list)
+      byte_list = []
+      byte = 0
+      bit_counter = 0
+      continue
+
+    # Data 0
+    elif lo_t <= code[i] <= hi_t and lo_t <= code[i + 1] <= hi_t:
+      bit_counter += 1
+    # Data 1
+    elif lo_t <= code[i] <= hi_t and lo_2t <= code[i + 1] <= hi_2t:
+      byte |= 1 << bit_counter
+      bit_counter += 1
+
+    # 不明なbit
+    else:
+      return None
+
+    # 最後のbit
+    if i == last - 1:
+      if bit_counter == 12 or bit_counter == 15 or bit_counter == 20:
+        byte_list.append(byte & 0x7F)
+        byte_list.append(byte >> 7)
+        frames.append(byte_list)
+        return frames
+      else:
+        return None
+
+
+@lru_cache(maxsize=64)
+def _decode(code):
+  """
+  Infrared.decodeの処理本体. 同じcodeの結果はキャッシュして再利用する
+  キャッシュした結果が変更されないよう, 引数と戻り値はタプルとする
+
+  Args:
+    code: 赤外線データ(タプル)
+  
+  Returns:
+    int: フォーマット. FORMAT_で始まる定数
+    tuple: バイト列データ(frames)をタプルにしたもの
+  """
+  # codeが短いか偶数の場合はエラーとする
+  if len(code) < 10 or len(code) % 2 == 0:
+    return FORMAT_UNKNOWN, ()
+
+  # Leader
+  for ir_format, (_, _, _, bounds) in _FMT_PARAMS.items():
+    if _cl(code[0], bounds['leader_mark']) and _cl(code[1], bounds['leader_space']):
+      break
+  else:
+    return FORMAT_UNKNOWN, ()
+
+  if ir_format == FORMAT_SONY:
+    frames = _decode_sony(code, bounds)
+  else:
+    frames = _decode_aeha_nec(code, bounds)
+
+  if frames is None:
+    return FORMAT_UNKNOWN, ()
+  return ir_format, tuple(map(tuple, frames))
+
+
+def _expand_byte(byte, t):
+  """
+  AEHA, NECフォーマットで1バイトのデータを表すcodeを返す
+
+  Args:
+    byte: バイトの値
+    t: フォーマットの基準周期[us]
+  
+  Returns:
+    tuple: LSBから順に(Mark, Space)を並べた16個のcode
+  """
+  codes = []
+  for i in range(8):
+    if (byte >> i) & 1:
+      codes += (t, t * 3)
+    else:
+      codes += (t, t)
+  return tuple(codes)
+
+
+# AEHA, NECの1バイト分のcodeの表. key:基準周期t, value:indexがバイトの値のリスト
+_BYTE_PULSES = {t: [_expand_byte(b, t) for b in range(256)] for t in (_T_AEHA, _T_NEC)}
+
+# 1バイト分のcodeに含まれるtの数. indexがバイトの値. bit 0はt*2, bit 1はt*4
+_BYTE_TCOUNT = [16 + 2 * bin(b).count('1') for b in range(256)]
+
+
+@lru_cache(maxsize=128)
+def _encode(ir_format, frames):
+  """
+  Infrared.encodeの処理本体. 同じ引数の結果はキャッシュして再利用する
+  キャッシュした結果が変更されないよう, 引数と戻り値はタプルとする
+
+  Args:
+    ir_format: フォーマット. FORMAT_で始まる定数
+    frames: バイト列データ(タプル)
+  
+  Returns:
+    tuple: 赤外線データ(code). framesの形式が正しくない場合は空のタプル
+
+  Raises:
+    ValueError: ir_formatの値が不明
+  """
+  code = []
+
+  if ir_format not in _FMT_PARAMS:
+    raise ValueError(ir_format)
+  t, leader_mark, leader_space, _ = _FMT_PARAMS[ir_format]
+
+  if ir_format == FORMAT_SONY:
+    # 各フレームに2つのデータがあるか確認
+    for frame in frames:
+      if len(frame) < 2:
+        return ()
+
+    # bitごとに追加するcodeとtの数. index 0:bit 0, 1:bit 1
+    bit_codes = ((t, t), (t, t * 2))
+    bit_t_counts = (2, 3)
+  else:
+    byte_pulses = _BYTE_PULSES[t]
+
+  first_frame = True
+  residual = 0  # これまでのWaitの丸め誤差の合計[us]
+
+  for frame in frames:
+    # Wait部
+    # NEC, SONYはフレーム周期が一定になるようWaitを決める
+    # 丸め誤差が蓄積しないよう, 前回までの誤差を差し引いてから丸める
+    if not first_frame:
+      if ir_format == FORMAT_AEHA:
+        code.append(_T_WAIT)
+      else:
+        if ir_format == FORMAT_NEC:
+          raw = 108000 - t * t_count - residual
+        else:
+          raw = 45000 - t * t_count - residual
+        rounded = _round(raw, 100)
+        residual = rounded - raw
+        code.append(rounded)
+
+    t_count = 0
+
+    # Leader. SONYはLeaderのSpaceを最初のbitのSpaceとして追加する
+    code.append(t * leader_mark)
+    t_count += leader_mark
+    if ir_format != FORMAT_SONY:
+      code.append(t * leader_space)
+      t_count += leader_space
+
+    # Data
+    if ir_format == FORMAT_AEHA or ir_format == FORMAT_NEC:
+      for byte in frame:
+        byte &= 0xFF
+        code.extend(byte_pulses[byte])
+        t_count += _BYTE_TCOUNT[byte]
+    elif ir_format == FORMAT_SONY:
+      d = frame[0] + (frame[1] << 7)
+      if frame[1] >= 0x100:
+        bits = 20
+      elif frame[1] >= 0x20:
+        bits = 15
+      else:
+        bits = 12
+
+      for i in range(bits):
+        bit = d & 1
+        code.extend(bit_codes[bit])
+        t_count += bit_t_counts[bit]
+        d = d >> 1
+
+    # Stop bit
+    if ir_format == FORMAT_AEHA or ir_format == FORMAT_NEC:
+      code.append(t)
+
+    first_frame = False
+
+  return tuple(code)
+
+
+def _round(n, m):
+  """
+  nをm単位で丸め処理を行う
+
+  Args:
+    n: 丸める対象の値
+    m: 丸める単位
+  
+  Returns:
+    int: 結果
+  """
+  return (n + m // 2) // m * m
+
+
+def _pack_codes(codes):
+  """
+  登録済みcode一覧(codes)をバイナリ形式に変換する
+  _BIN_MAGICの後に, codeごとに以下を並べる. 数値は全てリトルエンディアン
+    名前のバイト数(uint16), 名前(UTF-8), codeの長さ(uint32), code(uint32の配列)
+
+  Args:
+    codes: 登録済みcode一覧
+  
+  Returns:
+    bytes: 変換結果
+
+  Raises:
+    struct.error: 名前が65535バイトより長いか, codeにuint32で表せない値がある
+  """
+  parts = [_BIN_MAGIC]
+  for name, code in codes.items():
+    name_bytes = name.encode('utf-8')
+    parts.append(struct.pack('<H', len(name_bytes)))
+    parts.append(name_bytes)
+    parts.append(struct.pack(f'<I{len(code)}I', len(code), *code))
+  return b''.join(parts)
+
+
+def _unpack_codes(data):
+  """
+  _pack_codesで変換したバイナリ形式のデータを登録済みcode一覧(codes)に戻す
+
+  Args:
+    data: バイナリ形式のデータ. 先頭は_BIN_MAGIC
+  
+  Returns:
+    dict: 登録済みcode一覧
+
+  Raises:
+    ValueError: データの形式が正しくない
+  """
+  codes = {}
+  pos = len(_BIN_MAGIC)
+  try:
+    while pos < len(data):
+      name_len, = struct.unpack_from('<H', data, pos)
+      pos += 2
+      name = data[pos:pos + name_len].decode('utf-8')
+      pos += name_len
+      code_len, = struct.unpack_from('<I', data, pos)
+      pos += 4
+      code_format = f'<{code_len}I'
+      codes[name] = list(struct.unpack_from(code_format, data, pos))
+      pos += struct.calcsize(code_format)
+  except struct.error as e:
+    raise ValueError(e)
+  return codes
 
 
 class Infrared:
@@ -48,6 +515,13 @@ class Infrared:
         [7bitデータ, 13bitデータ] # Frame#1のデータ
         ...
       ]
+
+  pigpioとの接続
+    send, recordで最初に接続したpigpioとの接続は, close()を呼ぶまで使い回す.
+    使い終わったらclose()を呼ぶか, with文で使うこと. 
+    with Infrared() as ir:
+      ir.send(code)
+    close()されずに破棄された場合は, 破棄される時に接続を終了する.
   
   Attributes:
     gpio_send: 赤外線LEDのGPIO番号
@@ -61,6 +535,22 @@ class Infrared:
     self.gpio_rec = gpio_rec
     self.codes_path = codes_path
     self.codes = {}
+    self._pi = None  # pigpioへの接続. send, recordで使い回す
+    self._saved_hash = None  # 最後に読み書きしたファイルとcodesのハッシュ値
+    self._file_format = None  # 最後に読み書きしたファイルの(パス, バイナリ形式ならTrue)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def __del__(self):
+    # インタプリタ終了時などにpigpioとの接続が既に使えない場合は無視する
+    try:
+      self.close()
+    except Exception:
+      pass
 
   def send(self, code):
     """
@@ -71,49 +561,92 @@ class Infrared:
     
     Returns:
       bool: 成功ならTrue. pigpio接続失敗でFalse. 
+
+    Raises:
+      pigpio.error: 他のプロセスの波形でpigpioの波形数やパルス数が上限に達している
     """
-    pi = pigpio.pi()
-    if not pi.connected:
+    if not self._connect():
       return False
 
+    pi = self._pi
     pi.set_mode(self.gpio_send, pigpio.OUTPUT)
 
     # 生成できる波形の数には制限があるので、codeの長さごとにまとめて節約する
     # 送信する波形IDのリストの長さにも制限があるので、Mark(38kHzパルス)とSpace(待機)を1組とする
-    wids = {}  # key:(Mark長さ, Space長さ), value:ID
-    send_wids = []  # 送信する波形IDのリスト
+    # 生成した波形はclose()までpigpioに残しておき, 次回以降のsendでも再利用する. _waves参照
 
-    pi.wave_clear()
+    # (Mark長さ, Space長さ)の組のリスト. codeの最後のMarkはSpace長さ0とする
+    pairs = list(zip(code[0::2], list(code[1::2]) + [0]))
 
-    for i in range(len(code)):
-      if i % 2 != 0:  # MarkとSpaceをセットで処理するので奇数はスキップ
-        continue
+    with _waves_lock:
+      try:
+        self._create_waves(pairs)
+      except pigpio.error:
+        # pigpioの波形数やパルス数の上限に達した場合は, このプロセスで生成した波形を
+        # 削除してから作り直す. 他のプロセスの波形は削除しないので, このプロセスの波形が
+        # 無い場合は作り直しても失敗する
+        if not _waves:
+          raise
+        _delete_waves(pi)
+        self._create_waves(pairs)
+
+      send_wids = [_waves[(self.gpio_send, mark_length, space_length)] for mark_length, space_length in pairs]
 
-      if i == len(code) - 1:  # codeの最後のMarkの場合
-        mark_length = code[i]
-        space_length = 0
-      else:  # 通常のMarkの場合
-        mark_length = code[i]
-        space_length = code[i + 1]
-
-      # 同じ長さのMark, Space波形が無い場合は新しく生成
-      if (mark_length, space_length) not in wids:
-        pulses = []
-        n = mark_length // 26  # 38kHz = 26us周期の繰り返し回数
-        for j in range(n):
-          pulses.append(pigpio.pulse(1 << self.gpio_send, 0, 8))  # 8us highパルス
-          pulses.append(pigpio.pulse(0, 1 << self.gpio_send, 18))  # 18us lowパルス
+      pi.wave_chain(send_wids)
+
+    return True
+
+  def _create_waves(self, pairs):
+    """
+    送信に必要な波形のうち, 生成済みでないものを生成して_wavesに追加する
+
+    Args:
+      pairs: (Mark長さ, Space長さ)の組のリスト
+    """
+    pi = self._pi
+
+    # 38kHzの1周期分のパルス. 8us high, 18us low
+    carrier = [pigpio.pulse(1 << self.gpio_send, 0, 8), pigpio.pulse(0, 1 << self.gpio_send, 18)]
+
+    # 同じ長さのMark, Space波形が無い場合は新しく生成. 重複を除いて1つずつ生成する
+    # wave_createは追加済みの全パルスを1つの波形にするので, 波形ごとに
+    # wave_add_genericで1組のパルスをまとめて追加してからwave_createする
+    for mark_length, space_length in dict.fromkeys(pairs):
+      key = (self.gpio_send, mark_length, space_length)
+      if key not in _waves:
+        pulses = carrier * (mark_length // 26)  # 38kHz = 26us周期の繰り返し回数
         if space_length > 0:
           pulses.append(pigpio.pulse(0, 0, space_length))  # Space部
-        pi.wave_add_generic(pulses)  # Mark部
-        wids[(mark_length, space_length)] = pi.wave_create()
-      send_wids.append(wids[(mark_length, space_length)])
+        pi.wave_add_generic(pulses)
+        _waves[key] = pi.wave_create()
 
-    pi.wave_chain(send_wids)
-    pi.wave_clear()
-    pi.stop()
+  def close(self):
+    """
+    送信が終わるのを待ってこのプロセスで生成した波形を削除し, pigpioとの接続を終了する
+    波形は他のインスタンスと共有しているので, 他のインスタンスの次のsendでは作り直される
+    """
+    if self._pi is not None and self._pi.connected:
+      # 他のsendの実行中(__del__から呼ばれた場合を含む)は波形を使っているので削除しない.
+      # 残った波形は次のclose()かプロセス終了時に削除される
+      if _waves_lock.acquire(blocking=False):
+        try:
+          if _waves:
+            _delete_waves(self._pi)
+        finally:
+          _waves_lock.release()
+      self._pi.stop()
+    self._pi = None
+
+  def _connect(self):
+    """
+    pigpioに接続する. 接続済みの場合はその接続を使う
 
-    return True
+    Returns:
+      bool: 成功ならTrue. pigpio接続失敗でFalse. 
+    """
+    if self._pi is None or not self._pi.connected:
+      self._pi = pigpio.pi()
+    return self._pi.connected
 
   def record(self, timeout=10):
     """
@@ -130,55 +663,53 @@ class Infrared:
       int: 結果. REC_SUCCESS / REC_NO_DATA / REC_SHORT / REC_PIGPIO
       list: 赤外線データ(code)
     """
-    self._pi = pigpio.pi()
-    if not self._pi.connected:
+    if not self._connect():
       return REC_ERR_PIGPIO, []
 
     self._pi.set_mode(self.gpio_rec, pigpio.INPUT)
     self._pi.set_glitch_filter(self.gpio_rec, 100)
-    self._code = []
+    self._ticks = array('I')  # エッジを検出した時間. コールバックでは記録のみ行う
     self.last_tick = 0
 
-    self._pi.callback(self.gpio_rec, pigpio.EITHER_EDGE, self._call_back)
-
     self._recording = True  # 受信処理中のフラグセット
+    self._done = threading.Event()  # 受信終了時にコールバックからセットされる
 
-    i = 0
-    timeout_count = int(timeout) * 10
-    while self._recording:
-      time.sleep(0.1)
-      i += 1
-      if i >= timeout_count:
-        self._recording = False  # 受信処理中のフラグ解除
-        self._pi.set_watchdog(self.gpio_rec, 0)  # watchdog解除
-        self._pi.set_glitch_filter(self.gpio_rec, 0)
-        self._pi.stop()
-        return (REC_NO_DATA, [])  # タイムアウト
+    cb = self._pi.callback(self.gpio_rec, pigpio.EITHER_EDGE, self._call_back)
+
+    # 受信終了かタイムアウトまで待つ
+    received = self._done.wait(timeout)
 
+    self._recording = False  # 受信処理中のフラグ解除
+    cb.cancel()
     self._pi.set_watchdog(self.gpio_rec, 0)  # watchdog解除
     self._pi.set_glitch_filter(self.gpio_rec, 0)
-    self._pi.stop()
+
+    if not received:
+      return (REC_NO_DATA, [])  # タイムアウト
+
+    # エッジの時間の差からMark, Spaceの長さを求める
+    code = []
+    ticks = self._ticks
+    for i in range(1, len(ticks)):
+      length = pigpio.tickDiff(ticks[i - 1], ticks[i])
+
+      # 長さがばらつくので丸め処理. エッジの数だけ繰り返すので_roundは呼ばずに展開している
+      if length < 1000:
+        length = (length + 5) // 10 * 10
+      elif length < 2000:
+        length = (length + 25) // 50 * 50
+      else:
+        length = (length + 100) // 200 * 200
+
+      code.append(length)
 
     # codeが短い場合は戻り値を変える
-    if len(self._code) > 10:
+    if len(code) > 10:
       result = REC_SUCCESS
     else:
       result = REC_SHORT
 
-    return (result, self._code)
-
-  def _round(self, n, m):
-    """
-    nをm単位で丸め処理を行う
-
-    Args:
-      n: 丸める対象の値
-      m: 丸める単位
-    
-    Returns:
-      int: 結果
-    """
-    return (n + m // 2) // m * m
+    return (result, code)
 
   def _call_back(self, gpio, level, tick):
     """
@@ -197,28 +728,21 @@ class Infrared:
     if level == 0 or level == 1:
       if self.last_tick == 0:
         self._pi.set_watchdog(self.gpio_rec, 100)  # watchdog設定
-      else:
-        length = pigpio.tickDiff(self.last_tick, tick)
-
-        # 一定以上長い場合は受信終了
-        if length > _T_MAX_GAP:
-          self._recording = False  # 受信処理中のフラグ解除
-          return
-
-        # 長さがばらつくので丸め処理
-        if length < 1000:
-          length = self._round(length, 10)
-        elif length < 2000:
-          length = self._round(length, 50)
-        else:
-          length = self._round(length, 200)
 
-        self._code.append(length)
+      # 一定以上長い場合は受信終了
+      elif pigpio.tickDiff(self.last_tick, tick) > _T_MAX_GAP:
+        self._recording = False  # 受信処理中のフラグ解除
+        self._done.set()
+        return
+
+      # 長さの計算と丸め処理は受信終了後にまとめて行う
+      self._ticks.append(tick)
       self.last_tick = tick
 
     # Watchdogで呼ばれた場合
     else:
       self._recording = False  # 受信処理中のフラグ解除
+      self._done.set()
 
   def encode(self, ir_format, frames):
     """
@@ -229,94 +753,17 @@ class Infrared:
       frames: バイト列データ
     
     Returns:
-      list: 赤外線データ(code)
+      list: 赤外線データ(code). framesの形式が正しくない場合は空のリスト
 
     Raises:
       ValueError: ir_formatの値が不明
     """
-    code = []
-
-    if ir_format == FORMAT_AEHA:
-      t = _T_AEHA
-    elif ir_format == FORMAT_NEC:
-      t = _T_NEC
-    elif ir_format == FORMAT_SONY:
-      t = _T_SONY
-    else:
-      raise ValueError(ir_format)
-
-    first_frame = True
-
+    # 各フレームがリストかバイト列か確認
     for frame in frames:
-      # Wait部
-      if not first_frame:
-        if ir_format == FORMAT_AEHA:
-          code.append(_T_WAIT)
-        elif ir_format == FORMAT_NEC:
-          code.append(self._round(108000 - t * t_count, 100))
-        elif ir_format == FORMAT_SONY:
-          code.append(self._round(45000 - t * t_count, 100))
-
-      t_count = 0
-
-      # Leader
-      if ir_format == FORMAT_AEHA:
-        code.append(t * 8)
-        code.append(t * 4)
-        t_count += 12
-      elif ir_format == FORMAT_NEC:
-        code.append(t * 16)
-        code.append(t * 8)
-        t_count += 24
-      elif ir_format == FORMAT_SONY:
-        code.append(t * 4)
-        t_count += 4
-      else:
-        return code
-
-      # Data
-      if ir_format == FORMAT_AEHA or ir_format == FORMAT_NEC:
-        for byte in frame:
-          d = byte
-          for i in range(8):
-            bit = d & 1
-            if bit == 0:
-              code.append(t)
-              code.append(t)
-              t_count += 2
-            else:
-              code.append(t)
-              code.append(t * 3)
-              t_count += 4
-            d = d >> 1
-      elif ir_format == FORMAT_SONY:
-        d = frame[0] + (frame[1] << 7)
-        if frame[1] >= 0x100:
-          bits = 20
-        elif frame[1] >= 0x20:
-          bits = 15
-        else:
-          bits = 12
-
-        for i in range(bits):
-          bit = d & 1
-          if bit == 0:
-            code.append(t)
-            code.append(t)
-            t_count += 2
-          else:
-            code.append(t)
-            code.append(t * 2)
-            t_count += 3
-          d = d >> 1
-
-      # Stop bit
-      if ir_format == FORMAT_AEHA or ir_format == FORMAT_NEC:
-        code.append(t)
-
-      first_frame = False
+      if not isinstance(frame, (list, tuple, bytes, bytearray)):
+        return []
 
-    return code
+    return list(_encode(ir_format, tuple(map(tuple, frames))))
 
   def decode(self, code):
     """
@@ -331,150 +778,8 @@ class Infrared:
       int: フォーマット. FORMAT_で始まる定数
       list: バイト列データ(frames)
     """
-    ir_format = FORMAT_UNKNOWN
-
-    # codeが短いか偶数の場合はエラーとする
-    if len(code) < 10 or len(code) // 2 == 0:
-      return FORMAT_UNKNOWN, []
-
-    # Leader
-    if self._cl(code[0], _T_AEHA * 8) and self._cl(code[1], _T_AEHA * 4):
-      ir_format = FORMAT_AEHA
-      t = _T_AEHA
-    elif self._cl(code[0], _T_NEC * 16) and self._cl(code[1], _T_NEC * 8):
-      ir_format = FORMAT_NEC
-      t = _T_NEC
-    elif self._cl(code[0], _T_SONY * 4) and self._cl(code[1], _T_SONY):
-      ir_format = FORMAT_SONY
-      t = _T_SONY
-    else:
-      return FORMAT_UNKNOWN, []
-
-    frames = []
-    byte_list = []
-    byte = 0
-    bit_counter = 0
-    end_of_frame = False
-
-    if ir_format == FORMAT_AEHA or ir_format == FORMAT_NEC:
-      for i in range(2, len(code), 2):
-        # 新しいフレームの開始
-        if end_of_frame:
-          # Last index
-          if i == len(code) - 1:
-            return FORMAT_UNKNOWN, []
-
-          # フォーマットに合ったLeaderか確認
-          if ir_format == FORMAT_AEHA:
-            # Leader
-            if self._cl(code[i], _T_AEHA * 8) and self._cl(code[i + 1], _T_AEHA * 4):
-              end_of_frame = False
-              continue
-            # Repeat
-            elif self._cl(code[i], _T_AEHA * 8) and self._cl(code[i + 1], _T_AEHA * 8):
-              end_of_frame = False
-              continue
-            else:
-              return FORMAT_UNKNOWN, []
-          elif ir_format == FORMAT_NEC:
-            # Leader
-            if self._cl(code[i], _T_NEC * 16) and self._cl(code[i + 1], _T_NEC * 8):
-              end_of_frame = False
-              continue
-            # Repeat
-            elif self._cl(code[i], _T_NEC * 16) and self._cl(code[i + 1], _T_NEC * 4):
-              end_of_frame = False
-              continue
-            else:
-              return FORMAT_UNKNOWN, []
-
-        # フレームの途中
-        else:
-          # Last index
-          if i == len(code) - 1:
-            # Stopの長さとデータのbit数がByte単位か確認
-            if self._cl(code[i], t) and bit_counter == 0:
-              frames.append(byte_list)
-              return ir_format, frames
-            else:
-              return FORMAT_UNKNOWN, []
-
-          # Stopの後に長いSpaceがある場合は次のフレームがあると解釈
-          if self._cl(code[i], t) and code[i + 1] > _T_WAIT * 0.5:
-            frames.append(byte_list)
-            byte_list = []
-            byte = 0
-            end_of_frame = True
-            continue
-
-          # Data 0
-          if self._cl(code[i], t) and self._cl(code[i + 1], t):
-            bit_counter = (bit_counter + 1) % 8
-            if bit_counter == 0:
-              byte_list.append(byte)
-              byte = 0
-          # Data 1
-          elif self._cl(code[i], t) and self._cl(code[i + 1], t * 3):
-            byte = byte + (1 << bit_counter)
-            bit_counter = (bit_counter + 1) % 8
-            if bit_counter == 0:
-              byte_list.append(byte)
-              byte = 0
-
-          # 不明なbit
-          else:
-            return FORMAT_UNKNOWN, []
-
-    elif ir_format == FORMAT_SONY:
-      for i in range(1, len(code), 2):
-        # 長いSpaceの後にLeaderがある場合は次のフレームと解釈
-        if code[i] > _T_WAIT * 0.5 and self._cl(code[i + 1], t * 4) and i <= len(code) - 3:
-          byte_list.append(byte & 0x7F)
-          byte_list.append(byte >> 7)
-          frames.append(byte_list)
-          byte_list = []
-          byte = 0
-          bit_counter = 0
-          continue
-
-        # Data 0
-        elif self._cl(code[i], t) and self._cl(code[i + 1], t):
-          bit_counter += 1
-        # Data 1
-        elif self._cl(code[i], t) and self._cl(code[i + 1], t * 2):
-          byte = byte + (1 << bit_counter)
-          bit_counter += 1
-
-        # 不明なbit
-        else:
-          return FORMAT_UNKNOWN, []
-
-        # 最後のbit
-        if i == len(code) - 2:
-          if bit_counter == 12 or bit_counter == 15 or bit_counter == 20:
-            byte_list.append(byte & 0x7F)
-            byte_list.append(byte >> 7)
-            frames.append(byte_list)
-            return ir_format, frames
-          else:
-            return FORMAT_UNKNOWN, []
-
-  def _cl(self, length, target, tol=0.35):
-    """
-    赤外線のMark, Spaceの長さが目標値+/-許容範囲と一致するか確認する
-
-    Args:
-      length: 実測長さ
-      target: フォーマットなどで決まっている目標値
-      tol: 許容範囲の割合. 0.35なら+/-35%まで許容. 
-    
-    Returns:
-      bool: 範囲内に一致したらTrue. それ以外はFalse
-    """
-    if length > target * (1 - tol) and length < target * (1 + tol):
-      return True
-    else:
-      return False
+    ir_format, frames = _decode(tuple(code))
+    return ir_format, [list(frame) for frame in frames]
 
   def frames2str(self, ir_format, frames):
     """
@@ -488,56 +793,99 @@ class Infrared:
       str: 整形した文字列
     """
     if ir_format == FORMAT_AEHA:
-      s = 'Format AEHA\n'
+      parts = ['Format AEHA\n']
     elif ir_format == FORMAT_NEC:
-      s = 'Format NEC\n'
+      parts = ['Format NEC\n']
     elif ir_format == FORMAT_SONY:
-      s = 'Format SONY\n'
+      parts = ['Format SONY\n']
     else:
       return 'Format Unknown\n'
 
-    first_frame = True
-    for i in range(len(frames)):
-      if not first_frame:
-        s = s + '\n'
-      s = s + 'Frame#' + str(i + 1) + ' '
-      for j in range(len(frames[i])):
-        s = s + '0x{:02X}'.format(frames[i][j])
-        if j != len(frames[i]) - 1:
-          s = s + ', '
+    # 文字列の連結を繰り返さないよう, リストに追加して最後にjoinする
+    for i, frame in enumerate(frames):
+      if i > 0:
+        parts.append('\n')
+      parts.append(f'Frame#{i + 1} ')
+      parts.append(', '.join(f'0x{b:02X}' for b in frame))
 
-      if len(frames[i]) == 0:
-        s = s + 'Repeat\n'
+      if len(frame) == 0:
+        parts.append('Repeat\n')
 
-      first_frame = False
-    return s
+    return ''.join(parts)
 
   def save_codes(self):
     """
     登録済みcode一覧(codes)をファイルcodes_pathに保存する
+    load_codesで読み出したファイルに保存する場合は, 読み出した時と同じ形式で保存する. 
+    それ以外の場合はcodes_pathの拡張子が_BIN_EXTならバイナリ形式, それ以外はjson形式で保存する. 
+    最後に読み書きした時からcodesが変わっていなければ書き込まない. 
 
     Returns:
       bool: 成功ならTrue. 失敗ならFalse. 
     """
+    codes_hash = self._codes_hash()
+    if codes_hash is not None and codes_hash == self._saved_hash:
+      return True
+
+    if self._file_format is not None and self._file_format[0] == self.codes_path:
+      binary = self._file_format[1]
+    else:
+      binary = self.codes_path.lower().endswith(_BIN_EXT)
+
     try:
-      with open(self.codes_path, 'w') as f:
-        f.write(json.dumps(self.codes, ensure_ascii=False).replace('], ', '],\n'))
+      if not binary:
+        with open(self.codes_path, 'w', encoding='utf-8') as f:
+          # 全体を1つの文字列にせず, 1つのcodeを1行として順に書き込む
+          f.write('{')
+          separator = ''
+          for name, code in self.codes.items():
+            f.write(f'{separator}{json.dumps(name, ensure_ascii=False)}: {json.dumps(code)}')
+            separator = ',\n'
+          f.write('}')
+      else:
+        data = _pack_codes(self.codes)
+        with open(self.codes_path, 'wb') as f:
+          f.write(data)
+      self._saved_hash = codes_hash
+      self._file_format = (self.codes_path, binary)
       return True
-    except:
+    except (OSError, TypeError, ValueError, OverflowError, struct.error):
       return False
 
   def load_codes(self):
     """
     登録済みcode一覧をファイルから読み出してcodesに入れる
+    ファイルの先頭が_BIN_MAGICならバイナリ形式, それ以外はjson形式として読み出す. 
 
     Returns:
       bool: 成功ならTrue. 失敗ならFalse. 
     """
     try:
-      with open(self.codes_path, 'r') as f:
-        self.codes = json.load(f)
-        return True
-    except:
+      with open(self.codes_path, 'rb') as f:
+        data = f.read()
+      binary = data.startswith(_BIN_MAGIC)
+      if binary:
+        self.codes = _unpack_codes(data)
+      else:
+        self.codes = _json_loads(data)
+      self._saved_hash = self._codes_hash()
+      self._file_format = (self.codes_path, binary)
+      return True
+    except (OSError, ValueError):
       pass
     self.codes = {}
+    self._saved_hash = None
+    self._file_format = None
     return False
+
+  def _codes_hash(self):
+    """
+    codes_pathとcodesの内容からハッシュ値を計算する
+
+    Returns:
+      int: ハッシュ値. 計算できない内容の場合はNone
+    """
+    try:
+      return hash((self.codes_path, tuple((k, tuple(v)) for k, v in self.codes.items())))
+    except (AttributeError, TypeError):
+      return None